@@ -1,13 +1,25 @@
 #!/usr/bin/env python3
 
 import argparse
+import asyncio
 import csv
+import functools
+import itertools
 import json
 import os
+import random
+import re
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
-from typing import Any, Dict, List
+from typing import Any, Dict, Iterable, List
 
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+from json_io import dumps_json, loads_json
 from output_paths import GEMINI_PROFILES_DIR
 from runtime_paths import DEFAULT_CONTEXT_DIR
 
@@ -30,20 +42,37 @@ PREFERRED_MODELS = [
     "gemini-1.5-flash",
 ]
 DEFAULT_OUTPUT_DIR = GEMINI_PROFILES_DIR
+DEFAULT_CONCURRENCY = 8
+DEFAULT_PROMPT_CACHE_TTL_SECONDS = 3600
+DEFAULT_MAX_RETRIES = 3
+RETRY_BASE_DELAY_SECONDS = 2.0
+RETRYABLE_STATUS_CODES = {408, 429}
+# httpx is the google-genai transport; its timeouts and connection failures are
+# raised as-is rather than wrapped in an APIError.
+TRANSIENT_ERRORS = (TimeoutError, ConnectionError) + (
+    (httpx.TimeoutException, httpx.NetworkError, httpx.RemoteProtocolError) if httpx is not None else ()
+)
+# Anything other than letters, digits, "-" and "_" is replaced in output file names.
+UNSAFE_FILENAME_CHARS = re.compile(r"[^\w-]")
+ASCII_FILENAME_TABLE = bytes(
+    i if i < 128 and (chr(i).isalnum() or chr(i) in "-_") else ord("_")
+    for i in range(256)
+)
+# Optional ```json ... ``` wrapper some models put around structured output.
+MARKDOWN_JSON_FENCE = re.compile(r"\A```[^\n]*\n(.*?)(?:\n[ \t]*```)?\s*\Z", re.DOTALL)
+# KEY=value lines in .env files; blank lines and # comments never match.
+DOTENV_ASSIGNMENT = re.compile(r"^[ \t]*([^#=\s][^=\n]*?)[ \t]*=[ \t]*(.*?)[ \t]*$", re.MULTILINE)
 
 
 def load_dotenv_file(dotenv_path: Path = Path(".env")) -> None:
     if not dotenv_path.exists():
         return
 
-    for raw_line in dotenv_path.read_text(encoding="utf-8", errors="replace").splitlines():
-        line = raw_line.strip()
-        if not line or line.startswith("#") or "=" not in line:
-            continue
-        key, value = line.split("=", 1)
-        key = key.strip()
-        value = value.strip().strip("'").strip('"')
-        if key and key not in os.environ:
+    text = dotenv_path.read_text(encoding="utf-8", errors="replace")
+    for match in DOTENV_ASSIGNMENT.finditer(text):
+        key = match.group(1)
+        value = match.group(2).strip("'").strip('"')
+        if key not in os.environ:
             os.environ[key] = value
 
 
@@ -78,22 +107,38 @@ def read_json_file(path: Path) -> Any:
 
 
 def resolve_local_schema_refs(schema: Any, base_dir: Path) -> Any:
+    # Subtrees without external $refs are returned as-is; a container is only
+    # copied once one of its children actually changes.
     if isinstance(schema, dict):
-        if "$ref" in schema and isinstance(schema["$ref"], str):
-            ref = schema["$ref"]
-            if not ref.startswith("#"):
-                ref_path = (base_dir / ref).resolve()
-                ref_schema = read_json_file(ref_path)
-                return resolve_local_schema_refs(ref_schema, ref_path.parent)
-        return {
-            key: resolve_local_schema_refs(value, base_dir)
-            for key, value in schema.items()
-        }
+        ref = schema.get("$ref")
+        if isinstance(ref, str) and not ref.startswith("#"):
+            return load_resolved_schema((base_dir / ref).resolve())
+        resolved = schema
+        for key, value in schema.items():
+            resolved_value = resolve_local_schema_refs(value, base_dir)
+            if resolved_value is not value:
+                if resolved is schema:
+                    resolved = dict(schema)
+                resolved[key] = resolved_value
+        return resolved
     if isinstance(schema, list):
-        return [resolve_local_schema_refs(item, base_dir) for item in schema]
+        resolved_items = schema
+        for index, item in enumerate(schema):
+            resolved_item = resolve_local_schema_refs(item, base_dir)
+            if resolved_item is not item:
+                if resolved_items is schema:
+                    resolved_items = list(schema)
+                resolved_items[index] = resolved_item
+        return resolved_items
     return schema
 
 
+@functools.lru_cache(maxsize=None)
+def load_resolved_schema(path: Path) -> Any:
+    # Keyed on the resolved path, so repeated $refs to one file share a parsed subtree.
+    return resolve_local_schema_refs(read_json_file(path), path.parent)
+
+
 def load_context_files(context_dir: Path) -> Dict[str, str]:
     context_files: Dict[str, str] = {}
     for path in sorted(context_dir.glob("*.txt")):
@@ -138,20 +183,24 @@ def read_companies(
     manufacturers: bool = False,
 ) -> List[Dict[str, str]]:
     with csv_path.open("r", encoding="utf-8", newline="") as f:
-        reader = csv.DictReader(f)
-        rows = []
-        for row in reader:
-            nace_code = (row.get("NACE-BEL Code") or "").strip()
-            if manufacturers and nace_code != "C":
-                continue
-            rows.append(row)
-            if len(rows) >= n:
-                break
-    return rows
-
-
-def build_prompt(
-    company: Dict[str, str],
+        reader = csv.reader(f)
+        header = next(reader, [])
+        records: Iterable[List[str]] = (values for values in reader if values)
+        if manufacturers:
+            if "NACE-BEL Code" not in header:
+                return []
+            nace_index = header.index("NACE-BEL Code")
+            # Filter on the raw field so rejected rows never get a dict built.
+            records = (
+                values
+                for values in records
+                if nace_index < len(values) and values[nace_index].strip() == "C"
+            )
+        # islice stops reading the file as soon as n rows have been accepted.
+        return [dict(zip(header, values)) for values in itertools.islice(records, n)]
+
+
+def build_prompt_prefix(
     context_files: Dict[str, str],
     context_dir: Path,
 ) -> str:
@@ -172,37 +221,48 @@ def build_prompt(
             continue
         other_context.append(f"### {name}\n{content}")
 
-    company_json = json.dumps(company, ensure_ascii=False, indent=2)
-
     return (
         f"{master_prompt}\n\n"
         "# REFERENCE CONTEXT FILES\n"
         + "\n\n".join(other_context)
+    )
+
+
+def build_prompt(prompt_prefix: str, company: Dict[str, str]) -> str:
+    company_json = json.dumps(company, ensure_ascii=False, indent=2)
+    return (
+        prompt_prefix
         + "\n\n# COMPANY TO ANALYZE\n"
         + company_json
         + "\n\nReturn only the final JSON output for this company."
     )
 
 
-def call_gemini(client: Any, model: str, prompt: str, schema: Any) -> str:
-    config = {
+def schema_config_key() -> str:
+    try:
+        from google.genai import types
+    except ImportError:
+        return "response_json_schema"
+    fields = getattr(types.GenerateContentConfig, "model_fields", {})
+    # Some SDK versions use response_schema instead of response_json_schema.
+    if "response_schema" in fields and "response_json_schema" not in fields:
+        return "response_schema"
+    return "response_json_schema"
+
+
+def build_generation_config(schema: Any) -> Dict[str, Any]:
+    return {
         "response_mime_type": "application/json",
-        "response_json_schema": schema,
+        schema_config_key(): schema,
     }
-    try:
-        response = client.models.generate_content(
-            model=model,
-            contents=prompt,
-            config=config,
-        )
-    except TypeError:
-        # Some SDK versions use response_schema instead of response_json_schema.
-        config["response_schema"] = config.pop("response_json_schema")
-        response = client.models.generate_content(
-            model=model,
-            contents=prompt,
-            config=config,
-        )
+
+
+def call_gemini(client: Any, model: str, prompt: str, config: Dict[str, Any]) -> str:
+    response = client.models.generate_content(
+        model=model,
+        contents=prompt,
+        config=config,
+    )
 
     if getattr(response, "text", None):
         return response.text
@@ -212,6 +272,108 @@ def call_gemini(client: Any, model: str, prompt: str, schema: Any) -> str:
     return str(response)
 
 
+def create_prompt_cache(
+    client: Any,
+    model: str,
+    prompt_prefix: str,
+    ttl_seconds: int = DEFAULT_PROMPT_CACHE_TTL_SECONDS,
+) -> str | None:
+    try:
+        cache = client.caches.create(
+            model=model,
+            config={"contents": [prompt_prefix], "ttl": f"{ttl_seconds}s"},
+        )
+    except Exception as exc:
+        # Explicit caching is not available for every model/SDK version and rejects
+        # prefixes below the minimum cacheable size. Requests then send the full
+        # prompt, which Gemini can still serve from its implicit prefix cache.
+        print(f"Gemini prompt cache not created, sending full prompts: {exc}")
+        return None
+    return getattr(cache, "name", None)
+
+
+def refresh_prompt_cache(
+    client: Any,
+    cache_name: str,
+    ttl_seconds: int = DEFAULT_PROMPT_CACHE_TTL_SECONDS,
+) -> None:
+    try:
+        client.caches.update(name=cache_name, config={"ttl": f"{ttl_seconds}s"})
+    except Exception as exc:
+        # Requests fall back to the full prompt if the cache does expire.
+        print(f"Could not extend Gemini prompt cache {cache_name}: {exc}")
+
+
+def delete_prompt_cache(client: Any, cache_name: str) -> None:
+    try:
+        client.caches.delete(name=cache_name)
+    except Exception:
+        # The cache expires on its own after its TTL.
+        pass
+
+
+class RequestRateLimiter:
+    def __init__(self, requests_per_minute: int) -> None:
+        self.interval = 60.0 / requests_per_minute
+        self.next_start = 0.0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self.lock:
+            now = asyncio.get_running_loop().time()
+            delay = self.next_start - now
+            self.next_start = max(now, self.next_start) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+def is_transient_error(exc: Exception) -> bool:
+    # google.genai.errors.APIError carries the HTTP status as .code.
+    code = getattr(exc, "code", None)
+    if isinstance(code, int):
+        return code in RETRYABLE_STATUS_CODES or code >= 500
+    return isinstance(exc, TRANSIENT_ERRORS)
+
+
+def size_request_executor(concurrency: int) -> None:
+    # asyncio.to_thread runs on the loop's default executor, which is capped at
+    # min(32, cpu_count + 4) threads; give it one thread per allowed request so
+    # the semaphore, not the executor, is what bounds in-flight calls.
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=concurrency))
+
+
+async def call_gemini_async(
+    client: Any,
+    model: str,
+    prompt: str,
+    config: Dict[str, Any],
+    semaphore: asyncio.Semaphore,
+    rate_limiter: RequestRateLimiter | None = None,
+    max_retries: int = DEFAULT_MAX_RETRIES,
+) -> str:
+    for attempt in range(max_retries + 1):
+        try:
+            async with semaphore:
+                if rate_limiter is not None:
+                    await rate_limiter.acquire()
+                # The SDK client is synchronous; run it in a worker thread so calls overlap.
+                return await asyncio.to_thread(
+                    call_gemini,
+                    client=client,
+                    model=model,
+                    prompt=prompt,
+                    config=config,
+                )
+        except Exception as exc:
+            # Bad keys, invalid requests and programming errors fail immediately.
+            if attempt == max_retries or not is_transient_error(exc):
+                raise
+        # Back off outside the semaphore with full jitter so concurrent retries
+        # neither hold a slot nor hit the API again in lockstep.
+        await asyncio.sleep(random.uniform(0, RETRY_BASE_DELAY_SECONDS * 2**attempt))
+    raise AssertionError("unreachable")
+
+
 def normalize_model_name(name: str) -> str:
     base = name.removeprefix("models/")
     return MODEL_ALIASES.get(base, base)
@@ -276,40 +438,44 @@ def resolve_model_name(client: Any, requested_model: str) -> str:
 
 def parse_json_response(response_text: str) -> Any | None:
     text = response_text.strip()
-    if text.startswith("```"):
-        lines = text.splitlines()
-        if lines and lines[0].startswith("```"):
-            lines = lines[1:]
-        if lines and lines[-1].strip() == "```":
-            lines = lines[:-1]
-        text = "\n".join(lines).strip()
+    fenced = MARKDOWN_JSON_FENCE.match(text)
+    if fenced:
+        text = fenced.group(1)
     try:
-        return json.loads(text)
+        return loads_json(text)
     except json.JSONDecodeError:
         return None
 
 
-def normalize_produced_by_products(payload: Any) -> Any:
-    if isinstance(payload, dict):
-        normalized: Dict[str, Any] = {}
-        for key, value in payload.items():
-            if key == "produced_by_products" and isinstance(value, list):
-                names: List[str] = []
-                for item in value:
-                    if isinstance(item, str):
-                        names.append(item)
-                    elif isinstance(item, dict):
-                        name = item.get("name") or item.get("product_id")
-                        if isinstance(name, str) and name:
-                            names.append(name)
-                normalized[key] = names
-            else:
-                normalized[key] = normalize_produced_by_products(value)
-        return normalized
-
-    if isinstance(payload, list):
-        return [normalize_produced_by_products(item) for item in payload]
+def sanitize_file_name(name: str) -> str:
+    if name.isascii():
+        return name.encode("ascii").translate(ASCII_FILENAME_TABLE).decode("ascii")
+    return UNSAFE_FILENAME_CHARS.sub("_", name)
 
+
+def normalize_produced_by_products(payload: Any) -> Any:
+    # Rewrites produced_by_products lists in place; the rest of the payload is untouched.
+    stack: List[Any] = [payload]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, dict):
+            for key, value in node.items():
+                if not isinstance(value, (dict, list)):
+                    continue
+                if key == "produced_by_products" and isinstance(value, list):
+                    names: List[str] = []
+                    for item in value:
+                        if isinstance(item, str):
+                            names.append(item)
+                        elif isinstance(item, dict):
+                            name = item.get("name") or item.get("product_id")
+                            if isinstance(name, str) and name:
+                                names.append(name)
+                    value[:] = names
+                else:
+                    stack.append(value)
+        elif isinstance(node, list):
+            stack.extend(item for item in node if isinstance(item, (dict, list)))
     return payload
 
 
@@ -322,6 +488,8 @@ def run_pipeline(
     dry_run: bool,
     schema_path: Path | None,
     manufacturers: bool,
+    concurrency: int = DEFAULT_CONCURRENCY,
+    requests_per_minute: int | None = None,
 ) -> Path:
     context_files = load_context_files(context_dir)
     csv_path = context_dir / "Database Aalst - Sheet1.csv"
@@ -365,42 +533,65 @@ def run_pipeline(
             client = genai.Client(api_key=api_key)
         effective_model = resolve_model_name(client, model)
 
-    output_dir.mkdir(parents=True, exist_ok=True)
+    # The schema config and the master prompt/reference context are identical for
+    # every company, so both are built once.
+    generation_config = build_generation_config(schema)
+    prompt_prefix = build_prompt_prefix(context_files, context_dir)
+
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     run_dir = output_dir / f"gemini_profiles_n{n}_{timestamp}"
-    wrote_output = False
-
-    for idx, company in enumerate(companies, start=1):
-        prompt = build_prompt(company, context_files, context_dir=context_dir)
+    run_dir.mkdir(parents=True, exist_ok=True)
+
+    async def process_company(
+        idx: int,
+        company: Dict[str, str],
+        semaphore: asyncio.Semaphore,
+        rate_limiter: RequestRateLimiter | None,
+    ) -> bool:
+        prompt = build_prompt(prompt_prefix, company)
         if dry_run:
             response_text = "DRY_RUN: Gemini call skipped."
         else:
-            response_text = call_gemini(
+            response_text = await call_gemini_async(
                 client=client,
                 model=effective_model,
                 prompt=prompt,
-                schema=schema,
+                config=generation_config,
+                semaphore=semaphore,
+                rate_limiter=rate_limiter,
             )
         response_json = parse_json_response(response_text)
         if response_json is not None:
-            if not wrote_output:
-                run_dir.mkdir(parents=True, exist_ok=True)
-                wrote_output = True
             response_json = normalize_produced_by_products(response_json)
             company_name = company.get("Company Name", f"company_{idx}").strip()
-            safe_name = "".join(
-                c if c.isalnum() or c in ("-", "_") else "_" for c in company_name
-            )
+            safe_name = sanitize_file_name(company_name)
             company_path = run_dir / f"{idx:03d}_{safe_name}.json"
-            company_path.write_text(
-                json.dumps(response_json, ensure_ascii=False, indent=2),
-                encoding="utf-8",
-            )
+            company_path.write_bytes(dumps_json(response_json))
         print(
             f"Processed {idx}/{len(companies)}: "
             f"{company.get('Company Name', 'Unknown')}"
         )
+        return response_json is not None
+
+    async def process_all() -> List[bool]:
+        size_request_executor(concurrency)
+        semaphore = asyncio.Semaphore(concurrency)
+        rate_limiter = (
+            RequestRateLimiter(requests_per_minute) if requests_per_minute else None
+        )
+        return await asyncio.gather(
+            *(
+                process_company(idx, company, semaphore, rate_limiter)
+                for idx, company in enumerate(companies, start=1)
+            )
+        )
 
+    try:
+        wrote_output = any(asyncio.run(process_all()))
+    finally:
+        # Never leave an empty run directory for the launcher to pick up as the latest.
+        if not any(run_dir.iterdir()):
+            run_dir.rmdir()
     if not wrote_output:
         raise RuntimeError("No valid JSON outputs were generated.")
 
@@ -450,6 +641,18 @@ def parse_args() -> argparse.Namespace:
         action="store_true",
         help="Only process companies with NACE-BEL Code 'C'",
     )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help=f"Number of Gemini requests kept in flight at once (default: {DEFAULT_CONCURRENCY})",
+    )
+    parser.add_argument(
+        "--requests-per-minute",
+        type=int,
+        default=None,
+        help="Optional cap on Gemini requests started per minute (default: no cap)",
+    )
     return parser.parse_args()
 
 
@@ -458,6 +661,10 @@ def main() -> None:
 
     if args.n < 1:
         raise ValueError("--n must be >= 1")
+    if args.concurrency < 1:
+        raise ValueError("--concurrency must be >= 1")
+    if args.requests_per_minute is not None and args.requests_per_minute < 1:
+        raise ValueError("--requests-per-minute must be >= 1")
 
     output_path = run_pipeline(
         context_dir=args.context_dir,
@@ -468,6 +675,8 @@ def main() -> None:
         dry_run=args.dry_run,
         schema_path=args.schema_path,
         manufacturers=args.manufacturers,
+        concurrency=args.concurrency,
+        requests_per_minute=args.requests_per_minute,
     )
     print(f"Done. Output written to: {output_path}")
 
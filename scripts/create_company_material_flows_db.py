@@ -64,6 +64,12 @@ CREATE TABLE IF NOT EXISTS material_output_products (
     FOREIGN KEY (product_id) REFERENCES products_and_services(product_id) ON DELETE CASCADE
 );
 
+-- UNIQUE(company_name, website) treats NULL websites as distinct. This index is
+-- the upsert target instead: a missing website and an empty one identify the same
+-- company. company_name is NOT NULL, so it needs no such guard.
+CREATE UNIQUE INDEX IF NOT EXISTS idx_companies_name_website
+ON companies(company_name, IFNULL(website, ''));
+
 CREATE INDEX IF NOT EXISTS idx_products_company_id
 ON products_and_services(company_id);
 
@@ -85,12 +91,27 @@ BEGIN
     WHERE company_id = NEW.company_id;
 END;
 """
+# Candidate sort key, added separately so databases created before it existed are
+# upgraded in place. ALTER TABLE can only add VIRTUAL generated columns.
+VOLUME_RANK_COLUMN_SQL = """
+ALTER TABLE material_outputs ADD COLUMN volume_rank INTEGER GENERATED ALWAYS AS (
+    CASE volume_estimate WHEN 'large' THEN 1 WHEN 'medium' THEN 2 WHEN 'low' THEN 3 ELSE 4 END
+) VIRTUAL
+"""
+VOLUME_RANK_INDEX_SQL = """
+CREATE INDEX IF NOT EXISTS idx_material_outputs_volume_rank
+ON material_outputs(volume_rank, rank)
+"""
 
 
 def create_database(db_path: Path) -> None:
     db_path.parent.mkdir(parents=True, exist_ok=True)
     with sqlite3.connect(db_path) as connection:
         connection.executescript(SCHEMA_SQL)
+        columns = {row[1] for row in connection.execute("PRAGMA table_xinfo(material_outputs)")}
+        if "volume_rank" not in columns:
+            connection.execute(VOLUME_RANK_COLUMN_SQL)
+        connection.execute(VOLUME_RANK_INDEX_SQL)
 
 
 def parse_args() -> argparse.Namespace:
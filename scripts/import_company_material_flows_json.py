@@ -1,12 +1,19 @@
 #!/usr/bin/env python3
 
 import argparse
-import json
+import os
 import sqlite3
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import Any
+from typing import Any, Iterator
 
 from create_company_material_flows_db import DEFAULT_DB_PATH, create_database
+from json_io import loads_json
+
+
+# RETURNING was added in SQLite 3.35.0.
+SQLITE_SUPPORTS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
 
 
 def parse_args() -> argparse.Namespace:
@@ -31,8 +38,7 @@ def parse_args() -> argparse.Namespace:
 
 
 def read_json(path: Path) -> dict[str, Any]:
-    with path.open("r", encoding="utf-8") as handle:
-        data = json.load(handle)
+    data = loads_json(path.read_bytes())
     if not isinstance(data, dict):
         raise ValueError(f"{path} does not contain a top-level JSON object")
     return data
@@ -54,6 +60,22 @@ def require_array(data: dict[str, Any], key: str, source: Path) -> list[dict[str
     return value
 
 
+def require_known_products(
+    products: list[dict[str, Any]],
+    material_outputs: list[dict[str, Any]],
+    source: Path,
+) -> None:
+    product_names = {product["name"] for product in products}
+    missing = [
+        f"'{product_name}' (material output rank {item['rank']})"
+        for item in material_outputs
+        for product_name in item.get("produced_by_products", [])
+        if product_name not in product_names
+    ]
+    if missing:
+        raise ValueError(f"{source}: unknown product references: {', '.join(missing)}")
+
+
 def upsert_company(
     connection: sqlite3.Connection,
     company_profile: dict[str, Any],
@@ -71,8 +93,7 @@ def upsert_company(
         coordinates.get("longitude"),
         source_file.name,
     )
-    connection.execute(
-        """
+    sql = """
         INSERT INTO companies (
             company_name,
             street,
@@ -84,7 +105,7 @@ def upsert_company(
             longitude,
             source_file
         ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ON CONFLICT(company_name, website) DO UPDATE SET
+        ON CONFLICT(company_name, IFNULL(website, '')) DO UPDATE SET
             street = excluded.street,
             postal_code = excluded.postal_code,
             city = excluded.city,
@@ -92,17 +113,19 @@ def upsert_company(
             latitude = excluded.latitude,
             longitude = excluded.longitude,
             source_file = excluded.source_file
-        """,
-        payload,
-    )
-    row = connection.execute(
-        """
-        SELECT company_id
-        FROM companies
-        WHERE company_name = ? AND website = ?
-        """,
-        (company_profile["company_name"], company_profile.get("website")),
-    ).fetchone()
+    """
+    if SQLITE_SUPPORTS_RETURNING:
+        row = connection.execute(f"{sql} RETURNING company_id", payload).fetchone()
+    else:
+        connection.execute(sql, payload)
+        row = connection.execute(
+            """
+            SELECT company_id
+            FROM companies
+            WHERE company_name = ? AND IFNULL(website, '') = IFNULL(?, '')
+            """,
+            (company_profile["company_name"], company_profile.get("website")),
+        ).fetchone()
     if row is None:
         raise RuntimeError(f"Failed to resolve company_id for {source_file}")
     return int(row[0])
@@ -124,28 +147,32 @@ def insert_products(
     company_id: int,
     products: list[dict[str, Any]],
 ) -> dict[str, int]:
-    product_ids: dict[str, int] = {}
-    for index, product in enumerate(products, start=1):
-        cursor = connection.execute(
-            """
-            INSERT INTO products_and_services (
-                company_id,
-                name,
-                category,
-                volume_estimate,
-                product_order
-            ) VALUES (?, ?, ?, ?, ?)
-            """,
+    connection.executemany(
+        """
+        INSERT INTO products_and_services (
+            company_id,
+            name,
+            category,
+            volume_estimate,
+            product_order
+        ) VALUES (?, ?, ?, ?, ?)
+        """,
+        [
             (
                 company_id,
                 product["name"],
                 product["category"],
                 product.get("volume_estimate"),
                 index,
-            ),
-        )
-        product_ids[product["name"]] = int(cursor.lastrowid)
-    return product_ids
+            )
+            for index, product in enumerate(products, start=1)
+        ],
+    )
+    rows = connection.execute(
+        "SELECT name, product_id FROM products_and_services WHERE company_id = ?",
+        (company_id,),
+    ).fetchall()
+    return {name: int(product_id) for name, product_id in rows}
 
 
 def insert_material_outputs(
@@ -153,27 +180,26 @@ def insert_material_outputs(
     company_id: int,
     material_outputs: list[dict[str, Any]],
     product_ids: dict[str, int],
-    source_file: Path,
 ) -> None:
-    for item in material_outputs:
-        cursor = connection.execute(
-            """
-            INSERT INTO material_outputs (
-                company_id,
-                rank,
-                material,
-                output_kind,
-                name,
-                form,
-                treatment,
-                grade,
-                condition,
-                size_dimensions,
-                volume_estimate,
-                notes,
-                output_type
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """,
+    connection.executemany(
+        """
+        INSERT INTO material_outputs (
+            company_id,
+            rank,
+            material,
+            output_kind,
+            name,
+            form,
+            treatment,
+            grade,
+            condition,
+            size_dimensions,
+            volume_estimate,
+            notes,
+            output_type
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        [
             (
                 company_id,
                 item["rank"],
@@ -188,37 +214,74 @@ def insert_material_outputs(
                 item.get("volume_estimate"),
                 item.get("notes"),
                 item.get("output_type"),
-            ),
-        )
-        material_output_id = int(cursor.lastrowid)
-        for product_name in item.get("produced_by_products", []):
-            product_id = product_ids.get(product_name)
-            if product_id is None:
-                raise ValueError(
-                    f"{source_file}: unknown product reference '{product_name}' "
-                    f"for material output rank {item['rank']}"
-                )
-            connection.execute(
-                """
-                INSERT INTO material_output_products (
-                    material_output_id,
-                    product_id
-                ) VALUES (?, ?)
-                """,
-                (material_output_id, product_id),
             )
+            for item in material_outputs
+        ],
+    )
+    material_output_ids = dict(
+        connection.execute(
+            "SELECT rank, material_output_id FROM material_outputs WHERE company_id = ?",
+            (company_id,),
+        ).fetchall()
+    )
+    links = [
+        (int(material_output_ids[item["rank"]]), product_ids[product_name])
+        for item in material_outputs
+        for product_name in item.get("produced_by_products", [])
+    ]
+    connection.executemany(
+        """
+        INSERT INTO material_output_products (
+            material_output_id,
+            product_id
+        ) VALUES (?, ?)
+        """,
+        links,
+    )
 
 
-def import_file(connection: sqlite3.Connection, path: Path) -> None:
+def load_company_file(
+    path: Path,
+) -> tuple[dict[str, Any], list[dict[str, Any]], list[dict[str, Any]]]:
     data = read_json(path)
     company_profile = require_object(data, "company_profile", path)
     products = require_array(data, "products_and_services", path)
     material_outputs = require_array(data, "material_outputs", path)
+    require_known_products(products, material_outputs, path)
+    return company_profile, products, material_outputs
+
 
+def import_file(
+    connection: sqlite3.Connection,
+    path: Path,
+    company_file: tuple[dict[str, Any], list[dict[str, Any]], list[dict[str, Any]]],
+) -> None:
+    company_profile, products, material_outputs = company_file
     company_id = upsert_company(connection, company_profile, path)
     replace_company_children(connection, company_id)
     product_ids = insert_products(connection, company_id, products)
-    insert_material_outputs(connection, company_id, material_outputs, product_ids, path)
+    insert_material_outputs(connection, company_id, material_outputs, product_ids)
+
+
+def load_company_files(
+    executor: ThreadPoolExecutor,
+    json_files: list[Path],
+    max_in_flight: int,
+) -> Iterator[tuple[Path, Any]]:
+    # Yields files in order while keeping at most max_in_flight parsed or parsing
+    # ahead of the consumer, so a slow writer never holds every file in memory.
+    pending: deque[tuple[Path, Future]] = deque()
+    remaining = iter(json_files)
+    for json_file in remaining:
+        pending.append((json_file, executor.submit(load_company_file, json_file)))
+        if len(pending) >= max_in_flight:
+            break
+    while pending:
+        json_file, future = pending.popleft()
+        next_file = next(remaining, None)
+        if next_file is not None:
+            pending.append((next_file, executor.submit(load_company_file, next_file)))
+        yield json_file, future.result()
 
 
 def main() -> None:
@@ -237,9 +300,19 @@ def main() -> None:
     imported_count = 0
     with sqlite3.connect(db_path) as connection:
         connection.execute("PRAGMA foreign_keys = ON")
-        for json_file in json_files:
-            import_file(connection, json_file)
-            imported_count += 1
+        connection.execute("PRAGMA synchronous = NORMAL")
+        connection.execute("PRAGMA cache_size = -65536")
+        connection.execute("PRAGMA temp_store = MEMORY")
+        connection.execute("BEGIN")
+        connection.execute("PRAGMA defer_foreign_keys = ON")
+        # Files are read, parsed and validated on worker threads; only this thread
+        # touches SQLite. Results come back in sorted file order, so later files
+        # still win on upsert.
+        max_workers = min(32, (os.cpu_count() or 1) + 4)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for json_file, company_file in load_company_files(executor, json_files, 2 * max_workers):
+                import_file(connection, json_file, company_file)
+                imported_count += 1
         connection.commit()
 
     print(f"Imported {imported_count} files into {db_path}")
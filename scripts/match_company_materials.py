@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 
 import argparse
-import csv
+import asyncio
+import itertools
 import json
+import re
 import sqlite3
 from datetime import UTC, datetime
 from pathlib import Path
@@ -10,21 +12,172 @@ from typing import Any
 
 from create_company_jsons import (
     DEFAULT_API_VERSION,
+    DEFAULT_CONCURRENCY,
     DEFAULT_CONTEXT_DIR,
     DEFAULT_MODEL,
-    call_gemini,
+    DEFAULT_PROMPT_CACHE_TTL_SECONDS,
+    RequestRateLimiter,
+    build_generation_config,
+    call_gemini_async,
+    create_prompt_cache,
+    delete_prompt_cache,
+    is_transient_error,
     load_api_key,
     normalize_model_name,
     parse_json_response,
+    read_companies,
     read_json_file,
     read_text_file,
+    refresh_prompt_cache,
     resolve_local_schema_refs,
     resolve_model_name,
+    size_request_executor,
+)
+from json_io import dumps_json, loads_json
+from output_paths import DEFAULT_DB_PATH, MATERIAL_MATCHES_DIR, RESPONSE_CACHE_PATH
+from response_cache import (
+    DEFAULT_RESPONSE_CACHE_TTL_SECONDS,
+    get_cached_response,
+    open_response_cache,
+    response_cache_key,
+    store_cached_response,
 )
-from output_paths import DEFAULT_DB_PATH, MATERIAL_MATCHES_DIR
 
 
 DEFAULT_OUTPUT_DIR = MATERIAL_MATCHES_DIR
+WHITESPACE_RUN = re.compile(r"\s+")
+BATCH_PROMPT_HEADER = (
+    "# TARGET COMPANIES AND SHARED CANDIDATE SUPPLY POOL\n"
+    "Evaluate every entry in `targets` independently, using only the candidate material "
+    "outputs whose `candidate_id` is listed in that target's `candidate_ids`. Return one "
+    "`results` item per target containing its `index` and its `matches`.\n"
+)
+# Queries are module constants, so every call passes the identical string and hits
+# the connection's prepared-statement cache.
+COMPANY_KEYS_SQL = """
+CREATE TEMP TABLE company_keys AS
+SELECT
+    company_id,
+    normalize_text(company_name) AS name_key,
+    normalize_text(website) AS website_key
+FROM companies
+ORDER BY company_id;
+
+CREATE INDEX temp.idx_company_keys_name_website
+ON company_keys(name_key, website_key);
+
+CREATE INDEX temp.idx_company_keys_website
+ON company_keys(website_key);
+"""
+CSV_TARGETS_TABLE_SQL = """
+CREATE TEMP TABLE IF NOT EXISTS csv_targets (
+    idx INTEGER PRIMARY KEY,
+    name_key TEXT NOT NULL,
+    website_key TEXT NOT NULL
+)
+"""
+# One pass for all CSV rows: tier 1 matches name and website, tier 2 the name
+# only, tier 3 the website only; the lowest tier, then company_id, wins.
+MATCH_CSV_TARGETS_SQL = """
+WITH hits AS (
+    SELECT
+        t.idx,
+        k.company_id,
+        CASE
+            WHEN t.website_key != '' AND k.website_key = t.website_key THEN 1
+            ELSE 2
+        END AS tier
+    FROM csv_targets t
+    JOIN company_keys k ON k.name_key = t.name_key
+    WHERE t.name_key != ''
+    UNION ALL
+    SELECT t.idx, k.company_id, 3 AS tier
+    FROM csv_targets t
+    JOIN company_keys k ON k.website_key = t.website_key
+    WHERE t.website_key != ''
+),
+ranked AS (
+    SELECT
+        idx,
+        company_id,
+        ROW_NUMBER() OVER (PARTITION BY idx ORDER BY tier, company_id) AS pick
+    FROM hits
+)
+SELECT
+    r.idx,
+    c.company_id,
+    c.company_name,
+    COALESCE(c.website, '') AS website,
+    c.street,
+    c.postal_code,
+    c.city,
+    c.country,
+    c.latitude,
+    c.longitude
+FROM ranked r
+JOIN companies c ON c.company_id = r.company_id
+WHERE r.pick = 1
+"""
+FETCH_PRODUCTS_SQL = """
+SELECT company_id, name, category, volume_estimate, product_order
+FROM products_and_services
+WHERE company_id IN (SELECT value FROM json_each(?))
+ORDER BY company_id, product_order, name
+"""
+CANDIDATE_POOL_SELECT_SQL = """
+SELECT
+    m.company_id AS source_company_id,
+    c.company_name AS source_company,
+    COALESCE(c.website, '') AS source_website,
+    m.material AS candidate_material,
+    m.output_kind,
+    m.name AS candidate_name,
+    m.form AS candidate_form,
+    m.treatment,
+    m.grade,
+    m.condition,
+    COALESCE(m.size_dimensions, '') AS size_dimensions,
+    COALESCE(m.volume_estimate, '') AS volume_estimate,
+    COALESCE(m.notes, '') AS notes,
+    COALESCE(m.output_type, '') AS output_type,
+    (
+        SELECT json_group_array(DISTINCT p.name)
+        FROM material_output_products mop
+        JOIN products_and_services p ON p.product_id = mop.product_id
+        WHERE mop.material_output_id = m.material_output_id
+    ) AS produced_by_products
+FROM material_outputs m
+JOIN companies c ON c.company_id = m.company_id
+"""
+# Without a GROUP BY the (volume_rank, rank) index delivers rows in order; only
+# ties within a rank are sorted on the remaining keys.
+CANDIDATE_POOL_SQL = CANDIDATE_POOL_SELECT_SQL + """
+ORDER BY
+    m.volume_rank,
+    m.rank,
+    c.company_name,
+    m.name
+"""
+# Databases created before volume_rank existed are only upgraded by the importer;
+# the matcher reads them as they are, with the equivalent unindexed ordering.
+LEGACY_CANDIDATE_POOL_SQL = CANDIDATE_POOL_SELECT_SQL + """
+ORDER BY
+    CASE COALESCE(m.volume_estimate, '')
+        WHEN 'large' THEN 1
+        WHEN 'medium' THEN 2
+        WHEN 'low' THEN 3
+        ELSE 4
+    END,
+    m.rank,
+    c.company_name,
+    m.name
+"""
+
+
+def write_sidecar(directory: Path, file_name: str, text: str) -> str:
+    directory.mkdir(parents=True, exist_ok=True)
+    (directory / file_name).write_text(text, encoding="utf-8")
+    return f"{directory.name}/{file_name}"
 
 
 def parse_args() -> argparse.Namespace:
@@ -74,194 +227,150 @@ def parse_args() -> argparse.Namespace:
         default=150,
         help="Maximum number of candidate source outputs passed to the model per company.",
     )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1,
+        help="Number of target companies evaluated per Gemini request (default: 1).",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help=f"Number of Gemini requests kept in flight at once (default: {DEFAULT_CONCURRENCY}).",
+    )
+    parser.add_argument(
+        "--requests-per-minute",
+        type=int,
+        default=None,
+        help="Optional cap on Gemini requests started per minute (default: no cap).",
+    )
     parser.add_argument(
         "--dry-run",
         action="store_true",
         help="Do not call Gemini; write prompts and metadata only.",
     )
+    parser.add_argument(
+        "--keep-prompt",
+        action="store_true",
+        help="Write each prompt to a sidecar file next to the report (always on with --dry-run).",
+    )
+    parser.add_argument(
+        "--keep-raw",
+        action="store_true",
+        help="Write each raw Gemini response to a sidecar file next to the report (failed replies always are).",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help=f"Always call Gemini instead of reusing responses cached in {RESPONSE_CACHE_PATH}.",
+    )
+    parser.add_argument(
+        "--cache-ttl-seconds",
+        type=int,
+        default=DEFAULT_RESPONSE_CACHE_TTL_SECONDS,
+        help=f"Maximum age of a reused cached response (default: {DEFAULT_RESPONSE_CACHE_TTL_SECONDS}).",
+    )
     return parser.parse_args()
 
 
-def read_companies(csv_path: Path, n: int, manufacturers: bool) -> list[dict[str, str]]:
-    rows: list[dict[str, str]] = []
-    with csv_path.open("r", encoding="utf-8", newline="") as handle:
-        reader = csv.DictReader(handle)
-        for row in reader:
-            nace_code = (row.get("NACE-BEL Code") or "").strip()
-            if manufacturers and nace_code != "C":
-                continue
-            rows.append(row)
-            if len(rows) >= n:
-                break
-    return rows
+def normalize_text(value: str | None) -> str:
+    return WHITESPACE_RUN.sub(" ", (value or "").strip().casefold())
 
 
-def normalize_text(value: str | None) -> str:
-    return " ".join((value or "").strip().casefold().split())
+def csv_company_keys(csv_company: dict[str, str]) -> tuple[str, str]:
+    return (
+        normalize_text(csv_company.get("Company Name", "")),
+        normalize_text(csv_company.get("Website URL", "")),
+    )
 
 
-def fetch_db_company(
-    connection: sqlite3.Connection,
-    company_name: str,
-    website: str,
-) -> dict[str, Any] | None:
-    normalized_name = normalize_text(company_name)
-    normalized_website = normalize_text(website)
-    rows = connection.execute(
-        """
-        SELECT
-            company_id,
-            company_name,
-            website,
-            street,
-            postal_code,
-            city,
-            country,
-            latitude,
-            longitude
-        FROM companies
-        """
-    ).fetchall()
-
-    exact_both: dict[str, Any] | None = None
-    exact_name: dict[str, Any] | None = None
-    exact_website: dict[str, Any] | None = None
+def index_company_keys(connection: sqlite3.Connection) -> None:
+    # normalize_text runs once per stored company; the keyed copy and its indexes
+    # live in the connection's temp schema and are never written to the database.
+    connection.create_function("normalize_text", 1, normalize_text, deterministic=True)
+    connection.executescript(COMPANY_KEYS_SQL)
+
 
+def fetch_db_companies(
+    connection: sqlite3.Connection,
+    csv_companies: list[dict[str, str]],
+) -> dict[int, dict[str, Any]]:
+    connection.execute(CSV_TARGETS_TABLE_SQL)
+    connection.execute("DELETE FROM csv_targets")
+    # Rows with neither a name nor a website can never match, so they are not loaded.
+    connection.executemany(
+        "INSERT INTO csv_targets (idx, name_key, website_key) VALUES (?, ?, ?)",
+        [
+            (index, name_key, website_key)
+            for index, (name_key, website_key) in enumerate(map(csv_company_keys, csv_companies), start=1)
+            if name_key or website_key
+        ],
+    )
+    rows = connection.execute(MATCH_CSV_TARGETS_SQL).fetchall()
+    db_companies: dict[int, dict[str, Any]] = {}
     for row in rows:
-        candidate = {
-            "company_id": row[0],
-            "company_name": row[1],
-            "website": row[2] or "",
-            "street": row[3],
-            "postal_code": row[4],
-            "city": row[5],
-            "country": row[6],
-            "latitude": row[7],
-            "longitude": row[8],
-        }
-        row_name = normalize_text(candidate["company_name"])
-        row_website = normalize_text(candidate["website"])
-        if normalized_name and normalized_website and row_name == normalized_name and row_website == normalized_website:
-            exact_both = candidate
-            break
-        if normalized_name and row_name == normalized_name and exact_name is None:
-            exact_name = candidate
-        if normalized_website and row_website == normalized_website and exact_website is None:
-            exact_website = candidate
-
-    return exact_both or exact_name or exact_website
-
-
-def fetch_products(connection: sqlite3.Connection, company_id: int) -> list[dict[str, Any]]:
-    rows = connection.execute(
-        """
-        SELECT name, category, volume_estimate, product_order
-        FROM products_and_services
-        WHERE company_id = ?
-        ORDER BY product_order, name
-        """,
-        (company_id,),
-    ).fetchall()
-    return [
-        {
-            "name": row[0],
-            "category": row[1],
-            "volume_estimate": row[2],
-            "product_order": row[3],
-        }
-        for row in rows
-    ]
-
-
-def fetch_candidate_outputs(
+        db_company = dict(row)
+        db_companies[db_company.pop("idx")] = db_company
+    return db_companies
+
+
+def fetch_products(
     connection: sqlite3.Connection,
+    company_ids: list[int],
+) -> dict[int, list[dict[str, Any]]]:
+    products: dict[int, list[dict[str, Any]]] = {}
+    for row in connection.execute(FETCH_PRODUCTS_SQL, (json.dumps(company_ids),)):
+        product = dict(row)
+        products.setdefault(product.pop("company_id"), []).append(product)
+    return products
+
+
+def fetch_candidate_pool(connection: sqlite3.Connection) -> list[tuple[int, dict[str, Any]]]:
+    columns = {row["name"] for row in connection.execute("PRAGMA table_xinfo(material_outputs)")}
+    query = CANDIDATE_POOL_SQL if "volume_rank" in columns else LEGACY_CANDIDATE_POOL_SQL
+    rows = connection.execute(query).fetchall()
+
+    pool: list[tuple[int, dict[str, Any]]] = []
+    for row in rows:
+        candidate = dict(row)
+        # A JSON array keeps product names that contain commas intact.
+        candidate["produced_by_products"] = loads_json(candidate["produced_by_products"])
+        pool.append((candidate.pop("source_company_id"), candidate))
+    return pool
+
+
+def select_candidates(
+    pool: list[tuple[int, dict[str, Any]]],
     target_company_id: int,
     limit: int,
 ) -> list[dict[str, Any]]:
-    rows = connection.execute(
-        """
-        SELECT
-            c.company_name,
-            COALESCE(c.website, ''),
-            m.material,
-            m.output_kind,
-            m.name,
-            m.form,
-            m.treatment,
-            m.grade,
-            m.condition,
-            COALESCE(m.size_dimensions, ''),
-            COALESCE(m.volume_estimate, ''),
-            COALESCE(m.notes, ''),
-            COALESCE(m.output_type, ''),
-            GROUP_CONCAT(DISTINCT p.name)
-        FROM material_outputs m
-        JOIN companies c ON c.company_id = m.company_id
-        LEFT JOIN material_output_products mop ON mop.material_output_id = m.material_output_id
-        LEFT JOIN products_and_services p ON p.product_id = mop.product_id
-        WHERE m.company_id != ?
-        GROUP BY
-            c.company_name,
-            c.website,
-            m.material_output_id,
-            m.material,
-            m.output_kind,
-            m.name,
-            m.form,
-            m.treatment,
-            m.grade,
-            m.condition,
-            m.size_dimensions,
-            m.volume_estimate,
-            m.notes,
-            m.output_type
-        ORDER BY
-            CASE COALESCE(m.volume_estimate, '')
-                WHEN 'large' THEN 1
-                WHEN 'medium' THEN 2
-                WHEN 'low' THEN 3
-                ELSE 4
-            END,
-            m.rank,
-            c.company_name,
-            m.name
-        LIMIT ?
-        """,
-        (target_company_id, limit),
-    ).fetchall()
-
-    candidates: list[dict[str, Any]] = []
-    for row in rows:
-        produced_by = [item.strip() for item in (row[13] or "").split(",") if item and item.strip()]
-        candidates.append(
-            {
-                "source_company": row[0],
-                "source_website": row[1],
-                "candidate_material": row[2],
-                "output_kind": row[3],
-                "candidate_name": row[4],
-                "candidate_form": row[5],
-                "treatment": row[6],
-                "grade": row[7],
-                "condition": row[8],
-                "size_dimensions": row[9],
-                "volume_estimate": row[10],
-                "notes": row[11],
-                "output_type": row[12],
-                "produced_by_products": produced_by,
-            }
+    return list(
+        itertools.islice(
+            (
+                candidate
+                for source_company_id, candidate in pool
+                if source_company_id != target_company_id
+            ),
+            limit,
         )
-    return candidates
+    )
+
+
+def build_prompt_prefix(prompt_template: str, batched: bool = False) -> str:
+    # Static instructions first and nothing run-specific in them, so the prefix is
+    # byte-identical for every request and can be cached by Gemini.
+    header = BATCH_PROMPT_HEADER if batched else "# TARGET COMPANY AND CANDIDATE SUPPLY POOL\n"
+    return f"{prompt_template}\n\n{header}"
 
 
-def build_prompt(
-    prompt_template: str,
+def build_target(
     csv_company: dict[str, str],
     db_company: dict[str, Any],
     products: list[dict[str, Any]],
     candidates: list[dict[str, Any]],
-) -> str:
-    payload = {
+) -> dict[str, Any]:
+    return {
         "target_company": {
             "csv_company_name": csv_company.get("Company Name", ""),
             "csv_website": csv_company.get("Website URL", ""),
@@ -275,11 +384,70 @@ def build_prompt(
         },
         "candidate_material_outputs": candidates,
     }
-    return (
-        f"{prompt_template}\n\n"
-        "# TARGET COMPANY AND CANDIDATE SUPPLY POOL\n"
-        f"{json.dumps(payload, ensure_ascii=False, indent=2)}\n"
-    )
+
+
+def build_prompt_payload(target: dict[str, Any]) -> str:
+    return f"{dumps_json(target).decode()}\n"
+
+
+def build_batch_prompt_payload(targets: list[tuple[int, dict[str, Any]]]) -> str:
+    # Targets in a batch mostly share the same candidates, so each candidate is sent
+    # once and targets reference theirs by candidate_id. Candidates are the shared
+    # dicts from the run's candidate pool, which makes id() a stable identity here.
+    candidate_ids: dict[int, int] = {}
+    shared_candidates: list[dict[str, Any]] = []
+    entries: list[dict[str, Any]] = []
+    for index, target in targets:
+        target_candidate_ids: list[int] = []
+        for candidate in target["candidate_material_outputs"]:
+            candidate_id = candidate_ids.get(id(candidate))
+            if candidate_id is None:
+                candidate_id = len(shared_candidates) + 1
+                candidate_ids[id(candidate)] = candidate_id
+                shared_candidates.append({"candidate_id": candidate_id, **candidate})
+            target_candidate_ids.append(candidate_id)
+        entries.append(
+            {
+                "index": index,
+                "target_company": target["target_company"],
+                "candidate_ids": target_candidate_ids,
+            }
+        )
+    payload = {"targets": entries, "candidate_material_outputs": shared_candidates}
+    return f"{dumps_json(payload).decode()}\n"
+
+
+def build_batch_schema(schema: dict[str, Any]) -> dict[str, Any]:
+    result_schema = {
+        "type": "object",
+        "additionalProperties": False,
+        "required": ["index", *schema.get("required", [])],
+        "properties": {"index": {"type": "integer"}, **schema.get("properties", {})},
+    }
+    # Local "#/$defs/..." refs resolve against the document root, so the per-company
+    # definitions move to the root of the batch schema.
+    return {
+        **{key: schema[key] for key in ("$schema", "$defs", "definitions") if key in schema},
+        "type": "object",
+        "additionalProperties": False,
+        "required": ["results"],
+        "properties": {"results": {"type": "array", "items": result_schema}},
+    }
+
+
+def has_matches(result: Any) -> bool:
+    return isinstance(result, dict) and isinstance(result.get("matches"), list)
+
+
+def split_batch_response(parsed: Any) -> dict[int, Any]:
+    results = parsed.get("results") if isinstance(parsed, dict) else None
+    if not isinstance(results, list):
+        return {}
+    return {
+        result["index"]: result
+        for result in results
+        if isinstance(result, dict) and isinstance(result.get("index"), int)
+    }
 
 
 def safe_name(value: str) -> str:
@@ -292,6 +460,14 @@ def run_matching(args: argparse.Namespace) -> Path:
         raise ValueError("--n must be >= 1")
     if args.candidate_limit < 1:
         raise ValueError("--candidate-limit must be >= 1")
+    if args.batch_size < 1:
+        raise ValueError("--batch-size must be >= 1")
+    if args.concurrency < 1:
+        raise ValueError("--concurrency must be >= 1")
+    if args.requests_per_minute is not None and args.requests_per_minute < 1:
+        raise ValueError("--requests-per-minute must be >= 1")
+    if args.cache_ttl_seconds < 0:
+        raise ValueError("--cache-ttl-seconds must be >= 0")
 
     context_dir = args.context_dir.expanduser().resolve()
     csv_path = context_dir / "Database Aalst - Sheet1.csv"
@@ -308,12 +484,16 @@ def run_matching(args: argparse.Namespace) -> Path:
     if not db_path.exists():
         raise FileNotFoundError(f"Database not found: {db_path}")
 
-    csv_companies = read_companies(csv_path, args.n, args.manufacturers)
+    csv_companies = read_companies(csv_path, args.n, manufacturers=args.manufacturers)
     if not csv_companies:
         raise RuntimeError("No company rows found in CSV for the requested filters.")
 
-    prompt_template = read_text_file(prompt_path)
+    batched = args.batch_size > 1
+    prompt_prefix = build_prompt_prefix(read_text_file(prompt_path), batched=batched)
     schema = resolve_local_schema_refs(read_json_file(schema_path), schema_path.parent)
+    if batched:
+        schema = build_batch_schema(schema)
+    generation_config = build_generation_config(schema)
 
     client = None
     effective_model = args.model
@@ -343,69 +523,206 @@ def run_matching(args: argparse.Namespace) -> Path:
             "n": args.n,
             "manufacturers": args.manufacturers,
             "candidate_limit": args.candidate_limit,
+            "batch_size": args.batch_size,
         },
         "companies": [],
     }
 
-    with sqlite3.connect(db_path) as connection:
+    # Matching only reads the database; temp tables still work on a read-only connection.
+    with sqlite3.connect(f"{db_path.as_uri()}?mode=ro", uri=True) as connection:
         connection.row_factory = sqlite3.Row
+        connection.execute("PRAGMA temp_store = MEMORY")
+        connection.execute("PRAGMA mmap_size = 1073741824")
+        connection.execute("PRAGMA cache_size = -262144")
+        index_company_keys(connection)
+        db_companies = fetch_db_companies(connection, csv_companies)
+        # The aggregated pool is the same for every target; only the target's own
+        # outputs are excluded per company.
+        candidate_pool = fetch_candidate_pool(connection)
+        products_by_company = fetch_products(
+            connection,
+            [int(db_company["company_id"]) for db_company in db_companies.values()],
+        )
+        targets: list[tuple[int, dict[str, Any]]] = []
+        blank_rows = 0
         for index, csv_company in enumerate(csv_companies, start=1):
-            db_company = fetch_db_company(
-                connection,
-                csv_company.get("Company Name", ""),
-                csv_company.get("Website URL", ""),
-            )
+            db_company = db_companies.get(index)
             company_record: dict[str, Any] = {
                 "index": index,
                 "csv_company_name": csv_company.get("Company Name", ""),
                 "csv_website": csv_company.get("Website URL", ""),
                 "matched_in_database": db_company is not None,
             }
+            report["companies"].append(company_record)
+            if db_company is None and not any(csv_company_keys(csv_company)):
+                blank_rows += 1
+                company_record["error"] = "CSV row has neither a company name nor a website."
+                company_record["matches"] = []
+                continue
             if db_company is None:
                 company_record["error"] = "Company not found in database by name+website matching."
                 company_record["matches"] = []
-                report["companies"].append(company_record)
                 print(f"Skipped {index}/{len(csv_companies)}: {company_record['csv_company_name']} (not in DB)")
                 continue
 
-            products = fetch_products(connection, int(db_company["company_id"]))
-            candidates = fetch_candidate_outputs(
-                connection,
+            products = products_by_company.get(int(db_company["company_id"]), [])
+            candidates = select_candidates(
+                candidate_pool,
                 int(db_company["company_id"]),
                 args.candidate_limit,
             )
-            prompt = build_prompt(prompt_template, csv_company, db_company, products, candidates)
-
             company_record["database_company"] = db_company
             company_record["products_and_services"] = products
             company_record["candidate_pool_size"] = len(candidates)
+            targets.append((index, build_target(csv_company, db_company, products, candidates)))
+    if blank_rows:
+        print(f"Skipped {blank_rows} CSV row(s) with neither a company name nor a website.")
 
-            if args.dry_run:
-                company_record["matches"] = []
-                company_record["prompt"] = prompt
-            else:
-                response_text = call_gemini(
+    timestamp = datetime.now(UTC).strftime("%Y%m%d_%H%M%S")
+    suffix = "manufacturers" if args.manufacturers else "all"
+    output_path = args.output_dir / f"material_matches_n{args.n}_{suffix}_{timestamp}.json"
+    # Prompts and raw responses go to files next to the report instead of into it;
+    # records only reference them.
+    sidecar_dir = args.output_dir / output_path.stem
+    keep_prompt = args.keep_prompt or args.dry_run
+
+    # Only created once it is known that requests will be sent.
+    prompt_cache_name = None
+    if client is not None and targets:
+        prompt_cache_name = create_prompt_cache(client, effective_model, prompt_prefix)
+    prompt_cache_live = prompt_cache_name is not None
+    # The cached prefix is prepended server-side; those requests only carry the payload.
+    cached_generation_config = {**generation_config, "cached_content": prompt_cache_name}
+
+    async def send_prompt(
+        prompt_payload: str,
+        semaphore: asyncio.Semaphore,
+        rate_limiter: RequestRateLimiter | None,
+    ) -> str:
+        nonlocal prompt_cache_live
+        if prompt_cache_live:
+            try:
+                return await call_gemini_async(
                     client=client,
                     model=effective_model,
-                    prompt=prompt,
-                    schema=schema,
+                    prompt=prompt_payload,
+                    config=cached_generation_config,
+                    semaphore=semaphore,
+                    rate_limiter=rate_limiter,
+                )
+            except Exception as exc:
+                if is_transient_error(exc):
+                    raise
+                # Typically the cache expired or was evicted; send full prompts from now on.
+                if prompt_cache_live:
+                    prompt_cache_live = False
+                    print(f"Gemini prompt cache rejected, sending full prompts: {exc}")
+        return await call_gemini_async(
+            client=client,
+            model=effective_model,
+            prompt=prompt_prefix + prompt_payload,
+            config=generation_config,
+            semaphore=semaphore,
+            rate_limiter=rate_limiter,
+        )
+
+    async def keep_prompt_cache_alive() -> None:
+        # Extends the TTL at half its length so a long run never outlives the cache.
+        while prompt_cache_live:
+            await asyncio.sleep(DEFAULT_PROMPT_CACHE_TTL_SECONDS / 2)
+            await asyncio.to_thread(refresh_prompt_cache, client, prompt_cache_name)
+
+    # DB reads above stay serial on the one connection; only the Gemini calls overlap.
+    async def process_batch(
+        batch: list[tuple[int, dict[str, Any]]],
+        semaphore: asyncio.Semaphore,
+        rate_limiter: RequestRateLimiter | None,
+    ) -> None:
+        if batched:
+            prompt_payload = build_batch_prompt_payload(batch)
+        else:
+            prompt_payload = build_prompt_payload(batch[0][1])
+        # The full prompt is only materialised when it is kept or actually sent;
+        # with a Gemini prompt cache only the payload goes over the wire.
+        # A batch shares one prompt and response file, named after its first target.
+        sidecar_stem = f"{batch[0][0]:05d}"
+        prompt_file = None
+        if keep_prompt:
+            prompt_file = write_sidecar(sidecar_dir, f"{sidecar_stem}_prompt.txt", prompt_prefix + prompt_payload)
+
+        results: dict[int, Any] = {}
+        if not args.dry_run:
+            cache_key = None
+            response_text = None
+            if response_cache is not None:
+                cache_key = response_cache_key(
+                    effective_model, args.api_version, schema, prompt_prefix, prompt_payload
                 )
-                parsed = parse_json_response(response_text)
-                company_record["raw_response"] = response_text
-                if isinstance(parsed, dict) and isinstance(parsed.get("matches"), list):
-                    company_record["matches"] = parsed["matches"]
+                response_text = get_cached_response(response_cache, cache_key, args.cache_ttl_seconds)
+            from_cache = response_text is not None
+            if not from_cache:
+                response_text = await send_prompt(prompt_payload, semaphore, rate_limiter)
+            parsed = parse_json_response(response_text)
+            results = split_batch_response(parsed) if batched else {batch[0][0]: parsed}
+            # Only reuse replies that answer every target, so a malformed or partial
+            # reply is requested again next run instead of being replayed.
+            complete = all(has_matches(results.get(index)) for index, _ in batch)
+            if cache_key is not None and not from_cache and complete:
+                store_cached_response(response_cache, cache_key, response_text)
+            # A reply that left any target unanswered is always kept, once per request,
+            # so failures can be debugged without copying it into every record.
+            raw_response_file = None
+            if args.keep_raw or not complete:
+                raw_response_file = write_sidecar(sidecar_dir, f"{sidecar_stem}_response.txt", response_text)
+
+        for index, _ in batch:
+            company_record = report["companies"][index - 1]
+            if prompt_file is not None:
+                company_record["prompt_file"] = prompt_file
+            if args.dry_run:
+                company_record["matches"] = []
+            else:
+                result = results.get(index)
+                if has_matches(result):
+                    company_record["matches"] = result["matches"]
                 else:
                     company_record["matches"] = []
                     company_record["parse_error"] = "Model response was not valid JSON matching the expected schema."
-
-            report["companies"].append(company_record)
+                if raw_response_file is not None and (args.keep_raw or not has_matches(result)):
+                    company_record["raw_response_file"] = raw_response_file
             print(f"Processed {index}/{len(csv_companies)}: {company_record['csv_company_name']}")
 
+    async def process_all() -> None:
+        size_request_executor(args.concurrency)
+        semaphore = asyncio.Semaphore(args.concurrency)
+        rate_limiter = (
+            RequestRateLimiter(args.requests_per_minute) if args.requests_per_minute else None
+        )
+        refresher = asyncio.create_task(keep_prompt_cache_alive()) if prompt_cache_live else None
+        try:
+            await asyncio.gather(
+                *(
+                    process_batch(targets[start : start + args.batch_size], semaphore, rate_limiter)
+                    for start in range(0, len(targets), args.batch_size)
+                )
+            )
+        finally:
+            if refresher is not None:
+                refresher.cancel()
+
+    # The cache connection is only touched from the event loop thread.
+    response_cache = None if args.dry_run or args.no_cache else open_response_cache(RESPONSE_CACHE_PATH, args.cache_ttl_seconds)
+    asyncio.run(process_all())
+    if response_cache is not None:
+        response_cache.close()
+
+    if prompt_cache_name is not None:
+        # On failure the cache is left to expire after its TTL.
+        delete_prompt_cache(client, prompt_cache_name)
+
     args.output_dir.mkdir(parents=True, exist_ok=True)
-    timestamp = datetime.now(UTC).strftime("%Y%m%d_%H%M%S")
-    suffix = "manufacturers" if args.manufacturers else "all"
-    output_path = args.output_dir / f"material_matches_n{args.n}_{suffix}_{timestamp}.json"
-    output_path.write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+    with output_path.open("w", encoding="utf-8") as handle:
+        json.dump(report, handle, ensure_ascii=False, indent=2)
     return output_path
 
 
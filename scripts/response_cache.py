@@ -0,0 +1,66 @@
+import hashlib
+import json
+import sqlite3
+import time
+from pathlib import Path
+from typing import Any
+
+
+DEFAULT_RESPONSE_CACHE_TTL_SECONDS = 7 * 24 * 3600
+RESPONSE_CACHE_SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS responses (
+    cache_key TEXT PRIMARY KEY,
+    response_text TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+"""
+
+
+def response_cache_key(model: str, api_version: str, schema: Any, *prompt_parts: str) -> str:
+    # The prompt is hashed part by part, so callers never concatenate it just for
+    # the key; the JSON header line cannot contain a raw newline, so it stays unambiguous.
+    digest = hashlib.sha256(
+        json.dumps(
+            {"model": model, "api_version": api_version, "schema": schema},
+            ensure_ascii=False,
+            sort_keys=True,
+        ).encode("utf-8")
+    )
+    digest.update(b"\n")
+    for part in prompt_parts:
+        digest.update(part.encode("utf-8"))
+    return digest.hexdigest()
+
+
+def open_response_cache(
+    path: Path,
+    ttl_seconds: int = DEFAULT_RESPONSE_CACHE_TTL_SECONDS,
+) -> sqlite3.Connection:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    connection = sqlite3.connect(path)
+    connection.executescript(RESPONSE_CACHE_SCHEMA_SQL)
+    # Expired responses are never served again, so they are pruned on open to keep
+    # the cache from growing with every unique prompt.
+    with connection:
+        connection.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - ttl_seconds,))
+    return connection
+
+
+def get_cached_response(
+    connection: sqlite3.Connection,
+    cache_key: str,
+    ttl_seconds: int = DEFAULT_RESPONSE_CACHE_TTL_SECONDS,
+) -> str | None:
+    row = connection.execute(
+        "SELECT response_text FROM responses WHERE cache_key = ? AND created_at >= ?",
+        (cache_key, time.time() - ttl_seconds),
+    ).fetchone()
+    return None if row is None else row[0]
+
+
+def store_cached_response(connection: sqlite3.Connection, cache_key: str, response_text: str) -> None:
+    with connection:
+        connection.execute(
+            "INSERT OR REPLACE INTO responses (cache_key, response_text, created_at) VALUES (?, ?, ?)",
+            (cache_key, response_text, time.time()),
+        )